@@ -23,7 +23,6 @@ class TaskTreeBuilder(object):
             leaf = self.enqueueCommand(node)
             self.tree_leafs.append(leaf)
 
-        self.max_parallel = len(self.worklist)
         while len(self.worklist):
             task, node = self.worklist.pop()
 
@@ -31,11 +30,51 @@ class TaskTreeBuilder(object):
                 outgoing_task = self.findTask(outgoing)
                 task.addOutgoing(outgoing_task)
 
-            if len(self.worklist) > self.max_parallel:
-                self.max_parallel = len(self.worklist)
-
+        self.computeLevels()
         return self.cmd_list, self.tree_leafs
 
+    # A task's bottom level is the length of the longest chain of tasks from it
+    # to the end of the build. Running tasks with the highest bottom level first
+    # keeps the critical path moving.
+    #
+    # This also estimates how many tasks can run at once, as the largest number
+    # of tasks that sit at the same depth from the start of the build. Every
+    # leaf is at the first depth, so this is never less than the number of
+    # tasks that are ready immediately. It can undercount, though: with leaves
+    # L1 -> {X1, X2, X3} and L2 -> Y -> {Z1, Z2, Z3}, the widest depth holds 4
+    # tasks, but X1-X3 and Z1-Z3 can all run at once.
+    def computeLevels(self):
+        # Order tasks so that every task comes after all of its inputs.
+        order = []
+        remaining = {}
+        ready = list(self.tree_leafs)
+        while len(ready):
+            task = ready.pop()
+            order.append(task)
+            for outgoing in task.outgoing:
+                count = remaining.get(outgoing, len(outgoing.incoming)) - 1
+                remaining[outgoing] = count
+                if not count:
+                    ready.append(outgoing)
+
+        depths = {}
+        widths = {}
+        for task in order:
+            depth = 0
+            for incoming in task.incoming:
+                if depths[incoming] > depth:
+                    depth = depths[incoming]
+            depths[task] = depth + 1
+            widths[depth + 1] = widths.get(depth + 1, 0) + 1
+        self.max_parallel = max(widths.values()) if widths else 0
+
+        for task in reversed(order):
+            level = 0
+            for outgoing in task.outgoing:
+                if outgoing.bottom_level > level:
+                    level = outgoing.bottom_level
+            task.bottom_level = level + 1
+
     def findTask(self, node):
         if node in self.cache:
             return self.cache[node]
@@ -129,9 +168,8 @@ class Builder(object):
         # Update any dirty source file timestamps. It's important that files are
         # not modified in between being used as dependencies and the build
         # finishing; otherwise, the DAG state will be incoherent.
-        for entry in self.update_set:
-            if entry.dirty != nodetypes.ALWAYS_DIRTY:
-                self.cx.db.unmark_dirty(entry)
+        entries = [entry for entry in self.update_set if entry.dirty != nodetypes.ALWAYS_DIRTY]
+        self.cx.db.unmark_dirty_many(entries)
         self.cx.db.commit()
 
     def addDiscoveredSource(self, path):
@@ -253,6 +291,7 @@ class Builder(object):
         # dynamic edge table now. If the new input is an output (i.e. a
         # generated file), we have to ensure that there is a valid ordering
         # between the two.
+        new_edges = []
         for added in (discovered_set - dynamic_inputs):
             # Generally the set of dynamic inputs will be larger than the set of
             # strong inputs, so perform the set difference against the larger set,
@@ -265,8 +304,10 @@ class Builder(object):
                 if not self.ensureValidDependency(added, cmd_node.entry):
                     return False
 
-            # Add the edge.
-            self.cx.db.add_dynamic_edge(added, cmd_node.entry)
+            new_edges.append((added, cmd_node.entry))
+
+        if new_edges:
+            self.cx.db.add_dynamic_edges(new_edges)
 
         # Remove any dynamic links that are no longer needed.
         for removed in (dynamic_inputs - discovered_set):
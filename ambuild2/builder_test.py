@@ -0,0 +1,56 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import unittest
+from ambuild2 import nodetypes
+from ambuild2.builder import TaskTreeBuilder
+from ambuild2.task import Task
+
+class TaskLevelsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tasks = {}
+
+    def task(self, name):
+        if name not in self.tasks:
+            entry = nodetypes.Entry(len(self.tasks), nodetypes.Command, None, [name], None, 0,
+                                    nodetypes.DIRTY)
+            self.tasks[name] = Task(entry.id, entry, [name])
+        return self.tasks[name]
+
+    def link(self, source, targets):
+        for target in targets:
+            self.task(source).addOutgoing(self.task(target))
+
+    def compute(self, leafs):
+        tb = TaskTreeBuilder(None)
+        tb.tree_leafs = [self.task(name) for name in leafs]
+        tb.computeLevels()
+        return tb
+
+    def assertLevels(self, levels):
+        for name, level in levels.items():
+            self.assertEqual(self.task(name).bottom_level, level, name)
+
+class ChainTests(TaskLevelsTestCase):
+    def runTest(self):
+        self.link('a', ['b'])
+        self.link('b', ['c'])
+        tb = self.compute(['a'])
+        self.assertLevels({'a': 3, 'b': 2, 'c': 1})
+        self.assertEqual(tb.max_parallel, 1)
+
+class FanOutTests(TaskLevelsTestCase):
+    def runTest(self):
+        self.link('a', ['b', 'c', 'd'])
+        self.link('d', ['e'])
+        tb = self.compute(['a'])
+        self.assertLevels({'a': 3, 'b': 1, 'c': 1, 'd': 2, 'e': 1})
+        self.assertEqual(tb.max_parallel, 3)
+
+class DiamondTests(TaskLevelsTestCase):
+    def runTest(self):
+        self.link('a', ['b', 'c'])
+        self.link('b', ['d'])
+        self.link('c', ['d'])
+        self.link('x', ['c'])
+        tb = self.compute(['a', 'x'])
+        self.assertLevels({'a': 3, 'x': 3, 'b': 2, 'c': 2, 'd': 1})
+        self.assertEqual(tb.max_parallel, 2)
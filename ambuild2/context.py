@@ -144,6 +144,11 @@ class Context(object):
             self.db.printGraph()
             return True
 
+        # Damage computation and the build itself write to the graph as they
+        # go. All of it is one transaction, committed by the builder once the
+        # build finishes; any other exit leaves the graph untouched.
+        self.db.begin()
+
         if self.options.show_changed:
             dmg_list = damage.ComputeDamageGraph(self.db, only_changed = True)
             for entry in dmg_list:
@@ -58,6 +58,7 @@ def ComputeDamageGraph(database, only_changed = False):
         if not os.path.exists(node.path):
             graph.create.append(node)
 
+    # This also warms the folder cache for the scans below.
     database.query_mkdir(maybe_mkdir)
 
     dirty = []
@@ -14,6 +14,7 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import contextlib
 import errno
 import os, sys
 import sqlite3
@@ -23,6 +24,57 @@ from ambuild2 import nodetypes
 from ambuild2.nodetypes import Entry
 import traceback
 
+# Queries issued on hot paths. Keeping them as module constants means every
+# call hands sqlite3 the same string object, so finding the statement in the
+# connection's prepared statement cache is cheap.
+_Q_NODE_BY_ID = "select type, stamp, dirty, path, folder, data, env_id from nodes where id = ?"
+_Q_NODE_BY_PATH = """
+  select id, type, stamp, dirty, path, folder, data, env_id
+  from nodes
+  where path = ?
+"""
+_Q_NODES_WHERE = "select id, type, stamp, dirty, path, folder, data, env_id from nodes where "
+_Q_EDGE_OUT = "select outgoing from edges where incoming = ?"
+_Q_EDGE_IN = "select incoming from edges where outgoing = ?"
+_Q_WEAK_EDGE_IN = "select incoming from weak_edges where outgoing = ?"
+_Q_ALL_EDGE_OUT = """
+  select outgoing from edges where incoming = ?
+  union all
+  select outgoing from dynamic_edges where incoming = ?
+"""
+_Q_DYN_EDGE_IN = "select incoming from dynamic_edges where outgoing = ?"
+_Q_SHO_EDGE_OUT = "select outgoing from shared_outputs where incoming = ?"
+_Q_SHO_EDGE_IN = "select incoming from shared_outputs where outgoing = ?"
+# Each leg of the union uses one of the edge table's indexes; a plain
+# "incoming = ? or outgoing = ?" cannot use both.
+_Q_DROP_LINKS = """
+  delete from {0}
+  where rowid in (select rowid from {0} where incoming = ?
+                  union all
+                  select rowid from {0} where outgoing = ?)
+"""
+_Q_SET_DIRTY = "update nodes set dirty = ? where id = ?"
+_Q_SET_DIRTY_STAMP = "update nodes set dirty = ?, stamp = ? where id = ?"
+
+# Number of prepared statements each connection keeps around.
+_CACHED_STATEMENTS = 256
+
+# INSERT ... RETURNING was added in SQLite 3.35.
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Older SQLite builds cap the number of bound parameters per statement at 999
+# (SQLITE_MAX_VARIABLE_NUMBER).
+_MAX_QUERY_PARAMS = 999
+
+def _EdgeTableSchema(name):
+  return "create table if not exists {0}(       \
+      outgoing int not null                     \
+        references nodes(id) on delete cascade, \
+      incoming int not null                     \
+        references nodes(id) on delete cascade, \
+      unique (outgoing, incoming)               \
+    )".format(name)
+
 def CreateDatabase(path):
   cn = sqlite3.connect(path)
   queries = [
@@ -39,27 +91,18 @@ def CreateDatabase(path):
 
     # The edge table stores links that are specified by the build scripts;
     # this table is essentially immutable (except for reconfigures).
-    "create table if not exists edges(          \
-      outgoing int not null,                    \
-      incoming int not null,                    \
-      unique (outgoing, incoming)               \
-    )",
+    #
+    # All edge tables cascade deletes from nodes, so dropping a node drops
+    # its links.
+    _EdgeTableSchema('edges'),
 
     # The weak edge table stores links that are specified by build scripts,
     # but only to enforce ordering. They do not propagate damage or updates.
-    "create table if not exists weak_edges(     \
-      outgoing int not null,                    \
-      incoming int not null,                    \
-      unique (outgoing, incoming)               \
-    )",
+    _EdgeTableSchema('weak_edges'),
 
     # The dynamic edge table stores edges that are discovered as a result of
     # executing a command; for example, a |cp *| or C++ #includes.
-    "create table if not exists dynamic_edges(  \
-      outgoing int not null,                    \
-      incoming int not null,                    \
-      unique (outgoing, incoming)               \
-    )",
+    _EdgeTableSchema('dynamic_edges'),
 
     # List of nodes which trigger a reconfigure.
     "create table if not exists reconfigure(    \
@@ -73,14 +116,14 @@ def CreateDatabase(path):
       val varchar(255)                          \
     )",
 
-    "insert into vars (key, val) values ('db_version', '6')",
+    "insert into vars (key, val) values ('db_version', '7')",
 
-    "create index if not exists outgoing_edge on edges(outgoing)",
-    "create index if not exists incoming_edge on edges(incoming)",
-    "create index if not exists weak_outgoing_edge on weak_edges(outgoing)",
-    "create index if not exists weak_incoming_edge on weak_edges(incoming)",
-    "create index if not exists dyn_outgoing_edge on dynamic_edges(outgoing)",
-    "create index if not exists dyn_incoming_edge on dynamic_edges(incoming)",
+    # Each unique (outgoing, incoming) constraint already acts as a covering
+    # index for lookups by outgoing. These cover lookups in the other
+    # direction, so neither needs to touch the table itself.
+    "create index if not exists incoming_outgoing_edge on edges(incoming, outgoing)",
+    "create index if not exists weak_incoming_outgoing_edge on weak_edges(incoming, outgoing)",
+    "create index if not exists dyn_incoming_outgoing_edge on dynamic_edges(incoming, outgoing)",
 
     # The shared output table.
     "create table if not exists shared_outputs( \
@@ -88,8 +131,7 @@ def CreateDatabase(path):
       incoming int not null,                    \
       unique (outgoing, incoming)               \
     )",
-    "create index if not exists sho_outgoing_edge on shared_outputs(outgoing)",
-    "create index if not exists sho_incoming_edge on shared_outputs(incoming)",
+    "create index if not exists sho_incoming_outgoing_edge on shared_outputs(incoming, outgoing)",
 
     # The environment object table. Each blob is a (pickled) tuple,
     # containing (name, object) pairs. Currently, possible pairs:
@@ -130,9 +172,26 @@ class Database(object):
 
   def connect(self):
     assert not self.cn
-    self.cn = sqlite3.connect(self.path)
-    with IsolationChange(self.cn, None):
-      self.cn.execute("PRAGMA journal_mode = WAL;")
+    # Transactions are always explicit (see begin() and transaction()). This
+    # keeps sqlite3 from scanning each statement to decide whether to open one
+    # implicitly. Statements issued outside a transaction commit immediately.
+    self.cn = sqlite3.connect(self.path,
+                              isolation_level = None,
+                              cached_statements = _CACHED_STATEMENTS)
+    # Rows are plain tuples and every query reads them by position. Don't
+    # install sqlite3.Row here; a caller that wants named access should wrap
+    # its own rows.
+    self.cn.row_factory = None
+    self.cn.execute("PRAGMA journal_mode = WAL;")
+    # Generation is write-heavy with no concurrent readers. In WAL mode,
+    # synchronous=NORMAL only syncs on checkpoints; a crash can lose the last
+    # commit, but never corrupts the graph.
+    self.cn.execute("PRAGMA synchronous = NORMAL;")
+    self.cn.execute("PRAGMA temp_store = MEMORY;")
+    self.cn.execute("PRAGMA cache_size = -64000;")
+    self.cn.execute("PRAGMA mmap_size = 268435456;")
+    self.cn.execute("PRAGMA busy_timeout = 30000;")
+    self.cn.execute("PRAGMA foreign_keys = ON;")
     self.check_upgrade()
 
   def close(self):
@@ -147,8 +206,29 @@ class Database(object):
   def __exit__(self, type, value, traceback):
     self.close()
 
+  def begin(self):
+    self.cn.execute("BEGIN IMMEDIATE")
+
   def commit(self):
-    self.cn.commit()
+    if self.cn.in_transaction:
+      self.cn.execute("COMMIT")
+
+  def rollback(self):
+    if self.cn.in_transaction:
+      self.cn.execute("ROLLBACK")
+
+  # Wrap a batch of writes in a single transaction, so that importing a large
+  # graph costs one disk sync rather than one per statement. Nothing is written
+  # if an exception escapes the block.
+  @contextlib.contextmanager
+  def transaction(self):
+    self.begin()
+    try:
+      yield self
+    except:
+      self.rollback()
+      raise
+    self.commit()
 
   def flush_caches(self):
     self.node_cache_ = {}
@@ -165,7 +245,7 @@ class Database(object):
     except:
       version = 1
 
-    latest_version = 6
+    latest_version = 7
     if version == latest_version:
       return
     if version > latest_version:
@@ -177,20 +257,26 @@ class Database(object):
       util.ConsoleNormal
     )
 
-    if version == 1:
-      version = self.upgrade_to_v2()
+    # Run every step in one transaction, so a failed upgrade leaves the
+    # database at its old version.
+    with self.transaction():
+      if version == 1:
+        version = self.upgrade_to_v2()
 
-    if version == 2:
-      version = self.upgrade_to_v3()
+      if version == 2:
+        version = self.upgrade_to_v3()
 
-    if version == 3:
-      version = self.upgrade_to_v4()
+      if version == 3:
+        version = self.upgrade_to_v4()
 
-    if version == 4:
-      version = self.upgrade_to_v5()
+      if version == 4:
+        version = self.upgrade_to_v5()
 
-    if version == 5:
-      version = self.upgrade_to_v6()
+      if version == 5:
+        version = self.upgrade_to_v6()
+
+      if version == 6:
+        version = self.upgrade_to_v7()
 
   def upgrade_to_v2(self):
     queries = [
@@ -234,7 +320,6 @@ class Database(object):
     self.cn.execute("alter table nodestmp rename to nodes")
     self.cn.execute("drop table nodesold")
     self.cn.execute("insert or replace into vars (key, val) values ('db_version', ?)", (2,))
-    self.cn.commit()
     return 2
 
   def upgrade_to_v3(self):
@@ -250,14 +335,12 @@ class Database(object):
     for query in queries:
       self.cn.execute(query)
     self.cn.execute("insert or replace into vars (key, val) values ('db_version', ?)", (3,))
-    self.cn.commit()
     return 3
 
   def upgrade_to_v4(self):
     # If we're not on v4, assume the API version is 2.0.
     self.cn.execute("insert or replace into vars (key, val) values ('api_version', ?)", ('2.0',))
     self.cn.execute("insert or replace into vars (key, val) values ('db_version', ?)", (4,))
-    self.cn.commit()
     return 4
 
   def upgrade_to_v5(self):
@@ -267,15 +350,41 @@ class Database(object):
       data BLOB NOT NULL,                       \
       stamp REAL NOT NULL DEFAULT 0.0)")
     self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (5,))
-    self.cn.commit()
     return 5
 
   def upgrade_to_v6(self):
     self.cn.execute("CREATE UNIQUE INDEX IF NOT EXISTS node_path ON nodes(path)")
     self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (6,))
-    self.cn.commit()
     return 6
 
+  def upgrade_to_v7(self):
+    # Rebuild the edge tables with cascading foreign keys. Links to nodes that
+    # no longer exist are dropped along the way, as are the old single-column
+    # indexes, which belong to the old tables.
+    for table, prefix in [('edges', ''), ('weak_edges', 'weak_'), ('dynamic_edges', 'dyn_')]:
+      self.cn.execute("DROP TABLE IF EXISTS {0}_old".format(table))
+      self.cn.execute("ALTER TABLE {0} RENAME TO {0}_old".format(table))
+      self.cn.execute(_EdgeTableSchema(table))
+      self.cn.execute("""
+        INSERT INTO {0} (outgoing, incoming)
+          SELECT outgoing, incoming FROM {0}_old
+          WHERE outgoing IN (SELECT id FROM nodes)
+          AND incoming IN (SELECT id FROM nodes)
+      """.format(table))
+      self.cn.execute("DROP TABLE {0}_old".format(table))
+
+    # Index each edge table by (incoming, outgoing). Lookups by outgoing are
+    # served by the unique constraint.
+    self.cn.execute("DROP INDEX IF EXISTS sho_outgoing_edge")
+    self.cn.execute("DROP INDEX IF EXISTS sho_incoming_edge")
+    for table, prefix in [('edges', ''), ('weak_edges', 'weak_'), ('dynamic_edges', 'dyn_'),
+                          ('shared_outputs', 'sho_')]:
+      self.cn.execute(
+        "CREATE INDEX IF NOT EXISTS {0}incoming_outgoing_edge ON {1}(incoming, outgoing)".format(
+          prefix, table))
+    self.cn.execute("INSERT OR REPLACE INTO vars (key, val) VALUES ('db_version', ?)", (7,))
+    return 7
+
   def query_var(self, var):
     cursor = self.cn.execute("select val from vars where key = ?", (var,))
     row = cursor.fetchone()
@@ -315,6 +424,40 @@ class Database(object):
 
     return self.add_file(nodetypes.Source, path)
 
+  # Add many source files at once, returning their entries in the same order.
+  # The paths must be unique and not already in the database.
+  def add_sources(self, paths):
+    for path in paths:
+      assert path not in self.path_cache_
+      assert os.path.isabs(path)
+
+    ids = {}
+    if _HAS_RETURNING:
+      # Insert each chunk with one statement that also reports the new ids.
+      # RETURNING does not guarantee row order, so key them by path.
+      for i in range(0, len(paths), _MAX_QUERY_PARAMS):
+        chunk = paths[i:i + _MAX_QUERY_PARAMS]
+        values = ', '.join(["('{0}', ?)".format(nodetypes.Source)] * len(chunk))
+        query = "insert into nodes (type, path) values {0} returning id, path".format(values)
+        for id, path in self.cn.execute(query, chunk).fetchall():
+          ids[path] = id
+    else:
+      query = "insert into nodes (type, path, folder) values (?, ?, null)"
+      self.cn.executemany(query, [(nodetypes.Source, path) for path in paths])
+
+      # executemany does not report each new rowid, so look them up by path.
+      for i in range(0, len(paths), _MAX_QUERY_PARAMS):
+        chunk = paths[i:i + _MAX_QUERY_PARAMS]
+        query = "select id, path from nodes where path in ({0})".format(', '.join(['?'] * len(chunk)))
+        for id, path in self.cn.execute(query, chunk):
+          ids[path] = id
+
+    entries = []
+    for path in paths:
+      row = (nodetypes.Source, 0, 1, path, None, None, None)
+      entries.append(self.import_node(ids[path], row))
+    return entries
+
   def add_file(self, type, path, folder_entry = None):
     if folder_entry:
       folder_id = folder_entry.id
@@ -334,7 +477,7 @@ class Database(object):
     if not data:
       blob = None
     else:
-      blob = util.BlobType(util.CompatPickle(data))
+      blob = util.CompatPickle(data)
 
     # Note: it's a little gross/inconsistent how updates are handled. It seems
     # like Database should not be detecting refactoring, and then, we would not
@@ -399,7 +542,7 @@ class Database(object):
     if not data:
       blob = None
     else:
-      blob = util.BlobType(util.CompatPickle(data))
+      blob = util.CompatPickle(data)
     if not folder:
       folder_id = None
     else:
@@ -422,26 +565,40 @@ class Database(object):
     return entry
 
   def add_weak_edge(self, from_entry, to_entry):
-    query = "insert into weak_edges (outgoing, incoming) values (?, ?)"
-    self.cn.execute(query, (to_entry.id, from_entry.id))
-    if to_entry.weak_inputs is not None:
-      to_entry.weak_inputs.add(from_entry)
+    self.add_weak_edges([(from_entry, to_entry)])
 
   def add_strong_edge(self, from_entry, to_entry):
-    query = "insert into edges (outgoing, incoming) values (?, ?)"
-    self.cn.execute(query, (to_entry.id, from_entry.id))
-    if to_entry.strong_inputs is not None:
-      to_entry.strong_inputs.add(from_entry)
-    if from_entry.outgoing is not None:
-      from_entry.outgoing.add(to_entry)
+    self.add_strong_edges([(from_entry, to_entry)])
 
   def add_dynamic_edge(self, from_entry, to_entry):
+    self.add_dynamic_edges([(from_entry, to_entry)])
+
+  # The bulk variants take a list of (from_entry, to_entry) pairs, and insert
+  # them with a single prepared statement.
+  def add_weak_edges(self, edges):
+    query = "insert into weak_edges (outgoing, incoming) values (?, ?)"
+    self.cn.executemany(query, [(to_entry.id, from_entry.id) for from_entry, to_entry in edges])
+    for from_entry, to_entry in edges:
+      if to_entry.weak_inputs is not None:
+        to_entry.weak_inputs.add(from_entry)
+
+  def add_strong_edges(self, edges):
+    query = "insert into edges (outgoing, incoming) values (?, ?)"
+    self.cn.executemany(query, [(to_entry.id, from_entry.id) for from_entry, to_entry in edges])
+    for from_entry, to_entry in edges:
+      if to_entry.strong_inputs is not None:
+        to_entry.strong_inputs.add(from_entry)
+      if from_entry.outgoing is not None:
+        from_entry.outgoing.add(to_entry)
+
+  def add_dynamic_edges(self, edges):
     query = "insert into dynamic_edges (outgoing, incoming) values (?, ?)"
-    self.cn.execute(query, (to_entry.id, from_entry.id))
-    if to_entry.dynamic_inputs is not None:
-      to_entry.dynamic_inputs.add(from_entry)
-    if from_entry.outgoing is not None:
-      from_entry.outgoing.add(to_entry)
+    self.cn.executemany(query, [(to_entry.id, from_entry.id) for from_entry, to_entry in edges])
+    for from_entry, to_entry in edges:
+      if to_entry.dynamic_inputs is not None:
+        to_entry.dynamic_inputs.add(from_entry)
+      if from_entry.outgoing is not None:
+        from_entry.outgoing.add(to_entry)
 
   def add_shared_output_edge(self, from_entry, to_entry):
     # These don't factor into the DAG in any meaningful way, so we don't
@@ -479,20 +636,14 @@ class Database(object):
     if id in self.node_cache_:
       return self.node_cache_[id]
 
-    query = "select type, stamp, dirty, path, folder, data, env_id from nodes where id = ?"
-    cursor = self.cn.execute(query, (id,))
+    cursor = self.cn.execute(_Q_NODE_BY_ID, (id,))
     return self.import_node(id, cursor.fetchone())
 
   def query_path(self, path):
     if path in self.path_cache_:
       return self.path_cache_[path]
 
-    query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
-      from nodes
-      where path = ?
-    """
-    cursor = self.cn.execute(query, (path,))
+    cursor = self.cn.execute(_Q_NODE_BY_PATH, (path,))
     row = cursor.fetchone()
     if not row:
       return None
@@ -508,18 +659,11 @@ class Database(object):
       folder = row[4]
     else:
       folder = self.query_node(row[4])
-    if not row[5]:
-      blob = None
-    else:
-      blob = util.Unpickle(row[5])
-
-    node = Entry(id=id,
-                 type=row[0],
-                 path=row[3],
-                 blob=blob,
-                 folder=folder,
-                 stamp=row[1],
-                 dirty=row[2])
+    # Fields are (id, type, path, blob, folder, stamp, dirty). The blob is
+    # unpickled on first access.
+    node = Entry(id, row[0], row[3], None, folder, row[1], row[2])
+    if row[5]:
+      node.blob_data_ = row[5]
 
     if row[6]:
       node.tools_env = self.fetch_environment(row[6])
@@ -530,65 +674,50 @@ class Database(object):
       self.path_cache_[node.path] = node
     return node
 
+  # Batch version of query_node. Ids that are not cached yet are fetched with
+  # one IN query per chunk, rather than one query each.
+  def query_nodes(self, ids):
+    missing = [id for id in set(ids) if id not in self.node_cache_]
+    for i in range(0, len(missing), _MAX_QUERY_PARAMS):
+      chunk = missing[i:i + _MAX_QUERY_PARAMS]
+      query = _Q_NODES_WHERE + "id in ({0})".format(', '.join(['?'] * len(chunk)))
+      for row in self.cn.execute(query, chunk):
+        # Importing a node can import its folder, which may be in this chunk.
+        if row[0] not in self.node_cache_:
+          self.import_node(row[0], row[1:])
+    return [self.query_node(id) for id in ids]
+
+  def query_linked_nodes(self, query, params):
+    return self.query_nodes([row[0] for row in self.cn.execute(query, params)])
+
   def query_strong_outgoing(self, node):
     # Not cached yet.
-    outgoing = set()
-    query = "select outgoing from edges where incoming = ?"
-    for outgoing_id, in self.cn.execute(query, (node.id,)):
-      entry = self.query_node(outgoing_id)
-      outgoing.add(entry)
-    return outgoing
+    return set(self.query_linked_nodes(_Q_EDGE_OUT, (node.id,)))
 
   # Find the list of shared outputs this command generates.
   def query_shared_outputs(self, node):
     # Not cached.
-    outgoing = set()
-    query = "select outgoing from shared_outputs where incoming = ?"
-    for outgoing_id, in self.cn.execute(query, (node.id,)):
-      entry = self.query_node(outgoing_id)
-      outgoing.add(entry)
-    return outgoing
+    return set(self.query_linked_nodes(_Q_SHO_EDGE_OUT, (node.id,)))
 
   def query_outgoing(self, node):
     if node.outgoing is not None:
       return node.outgoing
 
-    node.outgoing = set()
-
-    query = "select outgoing from edges where incoming = ?"
-    for outgoing_id, in self.cn.execute(query, (node.id,)):
-      entry = self.query_node(outgoing_id)
-      node.outgoing.add(entry)
-
-    query = "select outgoing from dynamic_edges where incoming = ?"
-    for outgoing_id, in self.cn.execute(query, (node.id,)):
-      entry = self.query_node(outgoing_id)
-      node.outgoing.add(entry)
-
+    node.outgoing = set(self.query_linked_nodes(_Q_ALL_EDGE_OUT, (node.id, node.id)))
     return node.outgoing
 
   def query_weak_inputs(self, node):
     if node.weak_inputs is not None:
       return node.weak_inputs
 
-    query = "select incoming from weak_edges where outgoing = ?"
-    node.weak_inputs = set()
-    for incoming_id, in self.cn.execute(query, (node.id,)):
-      incoming = self.query_node(incoming_id)
-      node.weak_inputs.add(incoming)
-
+    node.weak_inputs = set(self.query_linked_nodes(_Q_WEAK_EDGE_IN, (node.id,)))
     return node.weak_inputs
 
   def query_strong_inputs(self, node):
     if node.strong_inputs is not None:
       return node.strong_inputs
 
-    query = "select incoming from edges where outgoing = ?"
-    node.strong_inputs = set()
-    for incoming_id, in self.cn.execute(query, (node.id,)):
-      incoming = self.query_node(incoming_id)
-      node.strong_inputs.add(incoming)
-
+    node.strong_inputs = set(self.query_linked_nodes(_Q_EDGE_IN, (node.id,)))
     return node.strong_inputs
 
   def query_command_of(self, node):
@@ -605,22 +734,13 @@ class Database(object):
     return cmd_entry
 
   def query_shared_commands_of(self, node):
-    query = "select incoming from shared_outputs where outgoing = ?"
-    commands = []
-    for row in self.cn.execute(query, (node.id,)):
-      commands.append(self.query_node(row[0]))
-    return commands
+    return self.query_linked_nodes(_Q_SHO_EDGE_IN, (node.id,))
 
   def query_dynamic_inputs(self, node):
     if node.dynamic_inputs is not None:
       return node.dynamic_inputs
 
-    query = "select incoming from dynamic_edges where outgoing = ?"
-    node.dynamic_inputs = set()
-    for incoming_id, in self.cn.execute(query, (node.id,)):
-      incoming = self.query_node(incoming_id)
-      node.dynamic_inputs.add(incoming)
-
+    node.dynamic_inputs = set(self.query_linked_nodes(_Q_DYN_EDGE_IN, (node.id,)))
     return node.dynamic_inputs
 
   def fetch_environment(self, env_id):
@@ -643,7 +763,7 @@ class Database(object):
       return self.env_reverse_lookup_[env_data]
 
     stamp = time.time()
-    blob = util.BlobType(util.CompatPickle(env_data))
+    blob = util.CompatPickle(env_data)
     query = "INSERT INTO environments (stamp, data) VALUES (?, ?)"
     cursor = self.cn.execute(query, (stamp, blob))
 
@@ -655,14 +775,12 @@ class Database(object):
   def mark_dirty(self, entry):
     assert entry.dirty != nodetypes.ALWAYS_DIRTY
 
-    query = "update nodes set dirty = ? where id = ?"
-    self.cn.execute(query, (nodetypes.DIRTY, entry.id))
+    self.cn.execute(_Q_SET_DIRTY, (nodetypes.DIRTY, entry.id))
     entry.dirty = nodetypes.DIRTY
 
   def unmark_dirty(self, entry, stamp=None):
     assert entry.dirty != nodetypes.ALWAYS_DIRTY
 
-    query = "update nodes set dirty = ?, stamp = ? where id = ?"
     if not stamp:
       if entry.isCommand():
         stamp = 0.0
@@ -678,67 +796,84 @@ class Database(object):
           )
           return
 
-    self.cn.execute(query, (nodetypes.NOT_DIRTY, stamp, entry.id))
+    self.cn.execute(_Q_SET_DIRTY_STAMP, (nodetypes.NOT_DIRTY, stamp, entry.id))
     entry.dirty = nodetypes.NOT_DIRTY
     entry.stamp = stamp
 
+  # Batched form of unmark_dirty(entry), for entries whose stamp must be read
+  # from disk. Files that cannot be stat'd are left dirty.
+  def unmark_dirty_many(self, entries):
+    rows = []
+    updated = []
+    for entry in entries:
+      assert entry.dirty != nodetypes.ALWAYS_DIRTY
+
+      if entry.isCommand():
+        stamp = 0.0
+      else:
+        try:
+          stamp = os.stat(entry.path).st_mtime
+        except OSError:
+          util.con_err(util.ConsoleRed,
+                       'Could not unmark file as dirty; leaving dirty: ', util.ConsoleBlue,
+                       entry.path, util.ConsoleNormal)
+          continue
+
+      rows.append((nodetypes.NOT_DIRTY, stamp, entry.id))
+      updated.append((entry, stamp))
+
+    self.cn.executemany(_Q_SET_DIRTY_STAMP, rows)
+    for entry, stamp in updated:
+      entry.dirty = nodetypes.NOT_DIRTY
+      entry.stamp = stamp
+
   def set_dirty_type(self, entry, dirtyType):
     if entry.dirty == dirtyType:
       return
-    query = "update nodes set dirty = ? where id = ?"
-    self.cn.execute(query, (dirtyType, entry.id))
+    self.cn.execute(_Q_SET_DIRTY, (dirtyType, entry.id))
     entry.dirty = dirtyType
 
   # Query all mkdir nodes.
-  def query_mkdir(self, aggregate):
-    query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
-      from nodes
-      where type == 'mkd'
-    """
-    for row in self.cn.execute(query):
-      node = self.import_node(row[0], row[1:])
+  # Import every node matching an SQL condition, passing each to aggregate.
+  # Nodes that are already cached are passed through as-is.
+  def query_nodes_where(self, condition, aggregate):
+    node_cache = self.node_cache_
+    import_node = self.import_node
+    for row in self.cn.execute(_Q_NODES_WHERE + condition):
+      node = node_cache.get(row[0])
+      if node is None:
+        node = import_node(row[0], row[1:])
       aggregate(node)
 
-  # Intended to be called before any nodes are imported.
+  # Query all mkdir nodes. Parent folders always have lower ids than their
+  # children, so ordering by id resolves every folder from the cache.
+  def query_mkdir(self, aggregate):
+    self.query_nodes_where("type == 'mkd' order by id", aggregate)
+
+  # Intended to be called after query_mkdir, which loads every folder into the
+  # node cache, so resolving each node's folder is a cache hit.
   def query_known_dirty(self, aggregate):
-    query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
-      from nodes
-      where dirty <> {0}
-      and type != 'mkd'
-    """.format(nodetypes.NOT_DIRTY)
-    for row in self.cn.execute(query):
-      node = self.import_node(row[0], row[1:])
-      aggregate(node)
+    condition = "dirty <> {0} and type != 'mkd'".format(nodetypes.NOT_DIRTY)
+    self.query_nodes_where(condition, aggregate)
 
   # Query all nodes that are not dirty, but need to be checked. Intended to
   # be called after query_dirty, and returns a mutually exclusive list.
   def query_maybe_dirty(self, aggregate):
-    query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
-      from nodes
-      where dirty = {0}
+    condition = """
+      dirty = {0}
       and (type == 'src' or type == 'out' or type == 'cpa')
     """.format(nodetypes.NOT_DIRTY)
-    for row in self.cn.execute(query):
-      id = row[6]
-      node = self.import_node(row[0], row[1:])
-      aggregate(node)
+    self.query_nodes_where(condition, aggregate)
 
   def query_commands(self, aggregate):
-    query = """
-      select id, type, stamp, dirty, path, folder, data, env_id
-      from nodes
-      where (type != 'src' and
-             type != 'out' and
-             type != 'sho' and
-             type != 'grp' and
-             type != 'mkd')
+    condition = """
+      (type != 'src' and
+       type != 'out' and
+       type != 'sho' and
+       type != 'grp' and
+       type != 'mkd')
     """
-    for row in self.cn.execute(query):
-      node = self.import_node(row[0], row[1:])
-      aggregate(node)
+    self.query_nodes_where(condition, aggregate)
 
   # Load all environments into the cache (and reverse lookup cache).
   def load_environments(self):
@@ -754,18 +889,11 @@ class Database(object):
   # Note that this does not update any caches. It should only be called
   # around cleanup.
   def drop_links(self, entry):
-    query = "delete from edges where incoming = ? or outgoing = ?"
-    self.cn.execute(query, (entry.id, entry.id))
-
-    query = "delete from dynamic_edges where incoming = ? or outgoing = ?"
-    self.cn.execute(query, (entry.id, entry.id))
-
-    query = "delete from weak_edges where incoming = ? or outgoing = ?"
-    self.cn.execute(query, (entry.id, entry.id))
+    for table in ['edges', 'dynamic_edges', 'weak_edges']:
+      self.cn.execute(_Q_DROP_LINKS.format(table), (entry.id, entry.id))
 
+  # Links in the edge tables are removed by their foreign key cascades.
   def drop_entry(self, entry):
-    self.drop_links(entry)
-
     query = "delete from nodes where id = ?"
     self.cn.execute(query, (entry.id,))
 
@@ -881,16 +1009,22 @@ class Database(object):
     entry.type = kind
 
   def vacuum(self):
-    with IsolationChange(self.cn, None):
-      self.cn.execute("vacuum")
+    self.cn.execute("vacuum")
 
   def printGraph(self):
     # Find all mkdir nodes.
     query = "select path from nodes where type = 'mkd'"
     for path, in self.cn.execute(query):
       print(' : mkdir \"' + path + '\"')
-    # Find all other nodes that have no outgoing edges.
-    query = "select id from nodes where id not in (select incoming from edges) and type != 'mkd'"
+    # Find all other nodes that have no outgoing edges. This is an anti-join
+    # so that each probe can use the incoming_outgoing_edge index.
+    query = """
+      select nodes.id
+      from nodes
+      left join edges on edges.incoming = nodes.id
+      where edges.incoming is null
+      and nodes.type != 'mkd'
+    """
     for id, in self.cn.execute(query):
       node = self.query_node(id)
       self.printGraphNode(node, 0)
@@ -902,16 +1036,3 @@ class Database(object):
       self.printGraphNode(incoming, indent + 1)
     for incoming in self.query_dynamic_inputs(node):
       self.printGraphNode(incoming, indent + 1)
-
-# Helper for Python 3.6 compatibility changes.
-class IsolationChange(object):
-  def __init__(self, cn, level):
-    self.cn = cn
-    self.level = level
-
-  def __enter__(self):
-    self.old_level = self.cn.isolation_level
-    self.cn.isolation_level = self.level
-
-  def __exit__(self, type, value, traceback):
-    self.cn.isolation_level = self.old_level
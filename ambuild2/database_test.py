@@ -0,0 +1,112 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import os
+import shutil
+import tempfile
+import unittest
+from ambuild2 import database
+from ambuild2 import nodetypes
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = database.CreateDatabase(os.path.join(self.folder, 'graph'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+class TransactionTests(DatabaseTestCase):
+    def runTest(self):
+        with self.db.transaction():
+            self.db.add_folder(None, 'a')
+        self.db.flush_caches()
+        self.assertEqual(self.db.query_path('a').type, nodetypes.Mkdir)
+
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.add_folder(None, 'b')
+                raise RuntimeError('abort')
+        self.db.flush_caches()
+        self.assertIsNone(self.db.query_path('b'))
+
+class DropEntryTests(DatabaseTestCase):
+    def runTest(self):
+        source = self.db.add_source(os.path.abspath('a.cpp'))
+        cmd = self.db.add_command(nodetypes.Command, None, ['cc', 'a.cpp'], nodetypes.DIRTY, None)
+        output = self.db.add_output(None, 'a.o')
+        self.db.add_strong_edge(source, cmd)
+        self.db.add_strong_edge(cmd, output)
+        self.db.commit()
+
+        self.db.drop_output(output)
+        self.db.commit()
+        cursor = self.db.cn.execute("select count(*) from edges where outgoing = ?", (output.id,))
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        self.db.drop_entry(cmd)
+        self.db.commit()
+        cursor = self.db.cn.execute("select count(*) from edges")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+class QueryNodesTests(DatabaseTestCase):
+    def runTest(self):
+        folder = self.db.add_folder(None, 'obj')
+        outputs = [self.db.add_output(folder, os.path.join('obj', str(i))) for i in range(5)]
+        ids = [entry.id for entry in reversed(outputs)]
+        self.db.commit()
+
+        self.db.flush_caches()
+        self.db.query_node(ids[2])
+        entries = self.db.query_nodes(ids + ids[:1])
+        self.assertEqual([entry.id for entry in entries], ids + ids[:1])
+        self.assertEqual(entries[0].folder.path, 'obj')
+
+class UnmarkDirtyManyTests(DatabaseTestCase):
+    def runTest(self):
+        present = os.path.join(self.folder, 'present.h')
+        with open(present, 'w') as fp:
+            fp.write('')
+        folder = os.path.join(self.folder, 'include')
+        os.mkdir(folder)
+        sources = [
+            self.db.add_source(present),
+            self.db.add_source(folder),
+            self.db.add_source(os.path.join(self.folder, 'missing.h')),
+        ]
+        for entry in sources:
+            self.db.mark_dirty(entry)
+        self.db.unmark_dirty_many(sources)
+        self.db.commit()
+        self.db.flush_caches()
+
+        entry = self.db.query_path(present)
+        self.assertEqual(entry.dirty, nodetypes.NOT_DIRTY)
+        self.assertEqual(entry.stamp, os.path.getmtime(present))
+        entry = self.db.query_path(folder)
+        self.assertEqual(entry.dirty, nodetypes.NOT_DIRTY)
+        entry = self.db.query_path(os.path.join(self.folder, 'missing.h'))
+        self.assertEqual(entry.dirty, nodetypes.DIRTY)
+
+class AddSourcesTests(DatabaseTestCase):
+    def runTest(self):
+        paths = [os.path.join(self.folder, name) for name in ['b.cpp', 'a.cpp', 'c.cpp']]
+        entries = self.db.add_sources(paths)
+        self.assertEqual([entry.path for entry in entries], paths)
+        self.assertEqual(len(set(entry.id for entry in entries)), 3)
+        self.db.commit()
+
+        self.db.flush_caches()
+        for entry in entries:
+            self.assertEqual(self.db.query_path(entry.path).id, entry.id)
+
+class LazyBlobTests(DatabaseTestCase):
+    def runTest(self):
+        argv = ['cc', '-c', 'a.cpp']
+        cmd = self.db.add_command(nodetypes.Command, None, argv, nodetypes.DIRTY, None)
+        self.db.commit()
+
+        self.db.flush_caches()
+        entry = self.db.query_node(cmd.id)
+        self.assertIsNotNone(entry.blob_data_)
+        self.assertEqual(entry.blob, argv)
+        self.assertIsNone(entry.blob_data_)
@@ -58,9 +58,17 @@ class Generator(BaseGenerator):
 
         self.db.load_environments()
         self.db.query_scripts(lambda id, path, stamp: self.old_scripts_.add(path))
+        # Must precede query_commands, so folder lookups hit the node cache.
         self.db.query_mkdir(lambda entry: self.old_folders_.add(entry))
         self.db.query_commands(lambda entry: self.old_commands_.add(entry))
-        self.db.set_var('api_version', str(self.cm.apiVersion))
+
+    def generate(self):
+        self.preGenerate()
+        with self.db.transaction():
+            self.db.set_var('api_version', str(self.cm.apiVersion))
+            self.cm.parseBuildScripts()
+            self.cleanup()
+        self.postGenerate()
 
     def cleanup(self):
         for path in self.rm_list_:
@@ -128,8 +136,6 @@ class Generator(BaseGenerator):
                     dead_folders.append(parent_entry)
 
     def postGenerate(self):
-        self.cleanup()
-        self.db.commit()
         self.db.vacuum()
         if self.is_bootstrap:
             self.saveVars()
@@ -364,9 +370,7 @@ class Generator(BaseGenerator):
 
     def parseInput(self, context, source, only_if_exists = False):
         if util.IsString(source):
-            if not os.path.isabs(source):
-                source = os.path.join(context.currentSourcePath, source)
-            source = os.path.normpath(source)
+            source = paths.NormJoin(context.currentSourcePath, source)
             if only_if_exists and not os.path.exists(source):
                 return
 
@@ -390,6 +394,33 @@ class Generator(BaseGenerator):
                      source.format(), util.ConsoleRed, '" as a file path.', util.ConsoleNormal)
         raise Exception('Tried to use non-file node as a file path')
 
+    # Same as parseInput() for each item, except that new source files are
+    # added to the database in one batch.
+    def parseInputs(self, context, sources):
+        entries = []
+        new_paths = []
+        new_path_set = set()
+
+        query_path = self.db.query_path
+        parse_input = self.parseInput
+        for source in sources:
+            if util.IsString(source):
+                source = paths.NormJoin(context.currentSourcePath, source)
+
+                entry = query_path(source)
+                if not entry:
+                    if source not in new_path_set:
+                        new_path_set.add(source)
+                        new_paths.append(source)
+                    continue
+                source = entry
+
+            entries.append(parse_input(context, source))
+
+        if new_paths:
+            entries.extend(self.db.add_sources(new_paths))
+        return entries
+
     def addCommand(self,
                    context,
                    node_type,
@@ -418,25 +449,25 @@ class Generator(BaseGenerator):
         # Build the set of weak links.
         weak_links = set()
         for weak_input in weak_inputs:
-            assert type(weak_input) is nodetypes.Entry
+            assert isinstance(weak_input, nodetypes.Entry)
             assert weak_input.type != nodetypes.Source
             weak_links.add(weak_input)
 
         # Build the set of strong links.
         strong_links = set()
         if inputs is not context.cm.ALWAYS_DIRTY:
-            for strong_input in inputs:
-                strong_input = self.parseInput(context, strong_input)
-                strong_links.add(strong_input)
+            strong_links.update(self.parseInputs(context, inputs))
 
         # Build the list of outputs.
         cmd_entry = None
         output_nodes = []
+        parse_output = self.parseOutput
+        query_command_of = self.db.query_command_of
         for output in outputs:
-            output_node = self.parseOutput(folder, output, nodetypes.Output)
+            output_node = parse_output(folder, output, nodetypes.Output)
             output_nodes.append(output_node)
 
-            input_entry = self.db.query_command_of(output_node)
+            input_entry = query_command_of(output_node)
             if not input_entry:
                 continue
 
@@ -523,9 +554,8 @@ class Generator(BaseGenerator):
         if len(shared_links) and self.refactoring:
             refactoring_error(shared_links.pop())
 
-        # Connect each output.
-        for output_node in output_links:
-            self.db.add_strong_edge(cmd_entry, output_node)
+        # Connect each output, and each new strong input.
+        strong_edges = [(cmd_entry, output_node) for output_node in output_links]
         for shared_output_node in shared_links:
             self.db.add_shared_output_edge(cmd_entry, shared_output_node)
 
@@ -537,8 +567,9 @@ class Generator(BaseGenerator):
         if len(strong_added) and self.refactoring:
             refactoring_error(strong_added.pop())
 
-        for strong_input in strong_added:
-            self.db.add_strong_edge(strong_input, cmd_entry)
+        strong_edges.extend([(strong_input, cmd_entry) for strong_input in strong_added])
+        if strong_edges:
+            self.db.add_strong_edges(strong_edges)
         for strong_input in strong_removed:
             self.db.drop_strong_edge(strong_input, cmd_entry)
 
@@ -550,8 +581,8 @@ class Generator(BaseGenerator):
         if len(weak_added) and self.refactoring:
             refactoring_error(weak_added.pop())
 
-        for weak_input in weak_added:
-            self.db.add_weak_edge(weak_input, cmd_entry)
+        if weak_added:
+            self.db.add_weak_edges([(weak_input, cmd_entry) for weak_input in weak_added])
         for weak_input in weak_removed:
             self.db.drop_weak_edge(weak_input, cmd_entry)
 
@@ -564,7 +595,7 @@ class Generator(BaseGenerator):
 
     def parseCxxDeps(self, context, binary, inputs, items):
         for val in items:
-            if type(val) is nodetypes.Entry:
+            if isinstance(val, nodetypes.Entry):
                 item = val
             elif util.IsString(val):
                 if val.startswith('-'):
@@ -582,7 +613,7 @@ class Generator(BaseGenerator):
             else:
                 item = val.node
 
-            if type(item) is list:
+            if isinstance(item, list):
                 inputs.extend(item)
             else:
                 inputs.append(item)
@@ -22,6 +22,17 @@ class BaseGenerator(object):
     def backend(self):
         raise Exception('Must be implemented!')
 
+    def generate(self):
+        self.preGenerate()
+        self.cm.parseBuildScripts()
+        self.postGenerate()
+
+    def preGenerate(self):
+        pass
+
+    def postGenerate(self):
+        pass
+
     def addSymlink(self, context, source, output_path):
         raise Exception('Must be implemented!')
 
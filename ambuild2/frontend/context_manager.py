@@ -19,6 +19,21 @@ import os
 import sys
 from ambuild2 import util
 
+BuildPyTemplate = """
+#!{exe}
+# vim set: ts=8 sts=2 sw=2 tw=99 et:
+import sys
+from ambuild2 import run
+
+if not run.CompatBuild(r"{build}"):
+  sys.exit(1)
+"""
+
+MakefileTemplate = """
+all:
+	"{exe}" "{py}"
+"""
+
 class ContextManager(object):
     def __init__(self, sourcePath, buildPath, originalCwd, options, args):
         super(ContextManager, self).__init__()
@@ -63,23 +78,14 @@ class ContextManager(object):
         return AutoContext(self, self.contextStack_[-1], name)
 
     def generateBuildFiles(self):
+        # Use native line endings, as a text-mode write would.
         build_py = os.path.join(self.buildPath, 'build.py')
-        with open(build_py, 'w') as fp:
-            fp.write("""
-#!{exe}
-# vim set: ts=8 sts=2 sw=2 tw=99 et:
-import sys
-from ambuild2 import run
+        text = BuildPyTemplate.format(exe = sys.executable, build = self.buildPath)
+        util.WriteFileBytes(build_py, text.replace('\n', os.linesep).encode('utf-8'))
 
-if not run.CompatBuild(r"{build}"):
-  sys.exit(1)
-""".format(exe = sys.executable, build = self.buildPath))
-
-        with open(os.path.join(self.buildPath, 'Makefile'), 'w') as fp:
-            fp.write("""
-all:
-	"{exe}" "{py}"
-""".format(exe = sys.executable, py = build_py))
+        text = MakefileTemplate.format(exe = sys.executable, py = build_py)
+        util.WriteFileBytes(os.path.join(self.buildPath, 'Makefile'),
+                            text.replace('\n', os.linesep).encode('utf-8'))
 
     def createGenerator(self, name):
         sys.stderr.write('Unrecognized build generator: {}\n'.format(name))
@@ -89,9 +95,7 @@ all:
     def generate(self, name = None):
         if self.generator is None:
             self.createGenerator(name)
-        self.generator.preGenerate()
-        self.parseBuildScripts()
-        self.generator.postGenerate()
+        self.generator.generate()
         if self.options.make_scripts:
             self.generateBuildFiles()
         return True
@@ -14,9 +14,16 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import functools
 import os
 from ambuild2 import util
 
+# Join and normalize a path. Generators resolve the same handful of folders
+# and inputs over and over, so the results are cached.
+@functools.lru_cache(maxsize = 4096)
+def NormJoin(base, path):
+    return os.path.normpath(os.path.join(base, path))
+
 # Given an optional contextual folder and a folder path, compute the full
 # relative path, erroring if it's outside the build folder.
 #
@@ -25,7 +32,7 @@ def ResolveFolder(parent, folder):
     parent_path = ''
     if parent:
         parent_path = parent.path
-    path = os.path.normpath(os.path.join(parent_path, folder))
+    path = NormJoin(parent_path, folder)
 
     if path.startswith('..'):
         util.con_err(util.ConsoleRed, 'Output path ', util.ConsoleBlue, path, util.ConsoleRed,
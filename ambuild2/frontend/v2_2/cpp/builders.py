@@ -425,16 +425,17 @@ class BinaryBuilder(BinaryBuilderBase):
         generator.parseCxxDeps(cx, self, inputs, self.compiler.postlink)
 
         # Add object files.
+        add_obj_task = generator.addCxxObjTask
+        add_rc_task = generator.addCxxRcTask
+        shared_cc_outputs = self.shared_cc_outputs
+        num_cxx_nodes = 2 if self.compiler.vendor.emits_dependency_file else 1
         for obj in self.objects:
             if obj.type == 'object':
-                cxx_nodes = generator.addCxxObjTask(cx, self.shared_cc_outputs, obj)
-                if self.compiler.vendor.emits_dependency_file:
-                    assert len(cxx_nodes) == 2
-                else:
-                    assert len(cxx_nodes) == 1
+                cxx_nodes = add_obj_task(cx, shared_cc_outputs, obj)
+                assert len(cxx_nodes) == num_cxx_nodes
                 inputs.append(cxx_nodes[0])
             elif obj.type == 'resource':
-                inputs.append(generator.addCxxRcTask(cx, obj))
+                inputs.append(add_rc_task(cx, obj))
 
         return self.link(generator, cx, inputs)
 
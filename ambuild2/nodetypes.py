@@ -89,6 +89,11 @@ ALWAYS_DIRTY = 2
 
 # The basic properties of a node as it exists in the database.
 class Entry(object):
+    # The node cache holds one Entry per graph node, so avoid a per-instance
+    # __dict__.
+    __slots__ = ('id', 'type', 'path', 'blob_', 'blob_data_', 'folder', 'stamp', 'dirty',
+                 'tools_env', 'strong_inputs', 'dynamic_inputs', 'weak_inputs', 'outgoing')
+
     def __init__(self, id, type, path, blob, folder, stamp, dirty):
         # Unique node ID (integer)
         self.id = id
@@ -109,7 +114,11 @@ class Entry(object):
         #
         # For binary nodes, it is a dictionary containing the file name and
         # file contents.
-        self.blob = blob
+        #
+        # Entries loaded from the database keep the pickled bytes in blob_data_
+        # until the blob is first accessed, since most are never looked at.
+        self.blob_ = blob
+        self.blob_data_ = None
 
         # For command nodes, this is a link to a 'Mkdir' node describing its
         # working directory.
@@ -138,6 +147,18 @@ class Entry(object):
 
         self.outgoing = None
 
+    @property
+    def blob(self):
+        if self.blob_data_ is not None:
+            self.blob_ = util.Unpickle(self.blob_data_)
+            self.blob_data_ = None
+        return self.blob_
+
+    @blob.setter
+    def blob(self, value):
+        self.blob_ = value
+        self.blob_data_ = None
+
     def isCommand(self):
         return IsCommand(self.type)
 
@@ -171,11 +192,11 @@ class Entry(object):
         return (' '.join([arg for arg in self.blob]))
 
 def combine(a, b):
-    if type(a) is Entry:
+    if isinstance(a, Entry):
         text_a = a.path
     else:
         text_a = a
-    if type(b) is Entry:
+    if isinstance(b, Entry):
         text_b = b.path
     else:
         if not len(b):
@@ -14,11 +14,14 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with AMBuild. If not, see <http://www.gnu.org/licenses/>.
+import collections
 import errno
 import multiprocessing as mp
 import multiprocessing.connection
+import pickle
 import platform
 import select
+import socket
 import sys
 try:
     import _winapi
@@ -38,29 +41,51 @@ class MessageReceiver(object):
             sys.exit(1)
 
     def pump_impl(self):
+        queued = collections.deque()
         while self.active_:
-            obj = self.channel.recv()
-            if obj['id'] == 'stop':
-                self.onShutdown()
-                return True
+            if not queued:
+                queued.append(self.channel.recv())
 
-            if obj['id'] not in self.messageMap:
-                raise Exception('Unhandled message: {}'.format(obj['id']))
-            self.messageMap[obj['id']](self, obj)
+            # The parent may send more work before the current message is
+            # handled. Pick up whatever has already arrived, so that a stop
+            # request skips any work that was queued ahead of it.
+            while self.channel.poll():
+                queued.append(self.channel.recv())
+            for message_id, _ in queued:
+                if message_id == 'stop':
+                    self.onShutdown()
+                    return True
+
+            message_id, message = queued.popleft()
+
+            if message_id not in self.messageMap:
+                raise Exception('Unhandled message: {}'.format(message_id))
+            self.messageMap[message_id](self, message)
 
     def halt_pump(self):
         self.active_ = False
 
+# Each message is a message id and an optional body, which is built from
+# builtin types (plus ToolsEnv objects). They are pickled directly, with the
+# newest protocol, rather than through multiprocessing's reducer-aware pickler.
+# Connections already frame each message with a length header.
+#
+# recv() returns a (message_id, body) tuple.
 class Channel(object):
     def __init__(self, sender, receiver):
         self.sender_ = sender
         self.receiver_ = receiver
 
-    def send(self, obj):
-        return self.sender_.send(obj)
+    def send(self, message_id, body = None):
+        data = pickle.dumps((message_id, body), pickle.HIGHEST_PROTOCOL)
+        return self.sender_.send_bytes(data)
 
     def recv(self):
-        return self.receiver_.recv()
+        return pickle.loads(self.receiver_.recv_bytes())
+
+    # Returns whether a message can be received without blocking.
+    def poll(self):
+        return self.receiver_.poll()
 
     def close(self):
         self.sender_.close()
@@ -74,6 +99,23 @@ class Channel(object):
     def poll_pipe(self):
         return self.receiver_
 
+# Task descriptions sent to workers are small. Size the socket buffers so that
+# a burst of them never blocks the sender. Messages coming back from workers use
+# a plain pipe with the system's default buffer.
+ChannelBufferSize = 256 * 1024
+
+# Create a connected pair of duplex connections. On POSIX this is an AF_UNIX
+# socket pair, like mp.Pipe(), but with larger buffers.
+def CreatePipe():
+    if not hasattr(socket, 'AF_UNIX'):
+        return mp.Pipe()
+
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    for sock in [a, b]:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, ChannelBufferSize)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ChannelBufferSize)
+    return mp.connection.Connection(a.detach()), mp.connection.Connection(b.detach())
+
 # Universal main for child processes.
 def child_main(target, channel, *args):
     obj = target(channel, *args)
@@ -89,16 +131,23 @@ class ProcessHost(object):
         self.channel = None
 
     def spawn(self, target, args):
-        parent_send, child_recv = mp.Pipe()
-        parent_recv, child_send = mp.Pipe()
+        # Tasks go to the child over a socket pair. Everything the child sends
+        # back travels on a one-way pipe, which needs no second socket buffer
+        # in each direction.
+        parent_conn, child_conn = CreatePipe()
+        results_reader, results_writer = mp.Pipe(duplex = False)
 
-        self.channel = Channel(parent_send, parent_recv)
-        child_channel = Channel(child_send, child_recv)
+        self.channel = Channel(parent_conn, results_reader)
+        child_channel = Channel(results_writer, child_conn)
 
         full_args = (target, child_channel) + args
         self.proc = mp.Process(target = child_main, args = full_args)
         self.proc.start()
 
+        # The child has its own copy of its ends now.
+        child_conn.close()
+        results_writer.close()
+
     @property
     def pid(self):
         return self.proc.pid
@@ -120,9 +169,7 @@ class ProcessManager(object):
     def close_all_children(self):
         for child in self.children_:
             try:
-                child.channel.send({
-                    'id': 'stop',
-                })
+                child.channel.send('stop')
                 child.channel.close()
             except:
                 pass
@@ -136,6 +183,10 @@ class ChannelPollerBase(object):
         self.cx_ = cx
         self.procs_ = procs[:]
 
+# Pollers hand out one message per poll() call, but every channel that was
+# ready when they last waited is drained before waiting again. When many tasks
+# finish at once, this costs one wait per burst rather than one per message.
+
 # If available, use native Python 3.3+ support for multiplexing.
 if hasattr(mp, 'connection') and hasattr(mp.connection, 'wait'):
 
@@ -144,6 +195,7 @@ if hasattr(mp, 'connection') and hasattr(mp.connection, 'wait'):
             super(ChannelPoller, self).__init__(cx, procs)
             self.map_ = {}
             self.pipes_ = None
+            self.ready_ = collections.deque()
 
         def __enter__(self):
             for proc in self.procs_:
@@ -152,8 +204,9 @@ if hasattr(mp, 'connection') and hasattr(mp.connection, 'wait'):
             return self
 
         def poll(self):
-            ready = mp.connection.wait(self.pipes_)
-            proc = self.map_[ready[0]]
+            if not self.ready_:
+                self.ready_.extend(mp.connection.wait(self.pipes_))
+            proc = self.map_[self.ready_.popleft()]
             return proc, proc.channel.recv()
 
         def __exit__(self, type, value, traceback):
@@ -163,7 +216,6 @@ if hasattr(mp, 'connection') and hasattr(mp.connection, 'wait'):
 # IO completion ports. I can't get ReOpenFile() to work, so we do something
 # extremely gross: spawn a bunch of threads.
 elif platform.system() == 'Windows':
-    import collections
     import threading
 
     def wait_on_pipe(poller, proc):
@@ -233,6 +285,7 @@ else:
             super(ChannelPoller, self).__init__(cx, procs)
             self.map_ = {}
             self.rdlist_ = []
+            self.ready_ = collections.deque()
 
         def __enter__(self):
             for proc in self.procs_:
@@ -241,16 +294,16 @@ else:
             return self
 
         def poll(self):
-            while True:
+            while not self.ready_:
                 try:
                     ready, _, _ = select.select(self.rdlist_, [], [])
-                    if ready:
-                        proc = self.map_[ready[0]]
-                        return proc, proc.channel.recv()
+                    self.ready_.extend(ready)
                 except select.error as e:
                     if e.args[0] == errno.EINTR:
                         continue
                     raise
+            proc = self.map_[self.ready_.popleft()]
+            return proc, proc.channel.recv()
 
         def __exit__(self, type, value, traceback):
             pass
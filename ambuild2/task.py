@@ -1,5 +1,7 @@
 # vim: set ts=8 sts=4 sw=4 tw=99 et:
+import collections
 import errno
+import heapq
 import multiprocessing as mp
 import shutil
 import os, sys
@@ -9,6 +11,13 @@ from ambuild2 import nodetypes
 from ambuild2 import process_manager
 from ambuild2 import util
 
+ENOENT = errno.ENOENT
+
+# Outputs are removed relative to an open handle on their folder when at least
+# this many of them share it.
+UnlinkDirFdThreshold = 4
+UnlinkDirFd = hasattr(os, 'O_DIRECTORY') and os.unlink in getattr(os, 'supports_dir_fd', ())
+
 class Task(object):
     def __init__(self, id, entry, outputs):
         self.id = id
@@ -23,6 +32,9 @@ class Task(object):
         self.incoming = set()
         self.tools_env = entry.tools_env
 
+        # Computed once the task tree is complete; see TaskTreeBuilder.
+        self.bottom_level = 0
+
     def addOutgoing(self, task):
         self.outgoing.append(task)
         task.incoming.add(self)
@@ -58,13 +70,27 @@ def GetMsvcInclusionPattern(vars, tools_env):
             return tools_env.props['inclusion_pattern']
     return None
 
+# A task sent from TaskMaster to a worker. It travels as a plain tuple, so that
+# field names are not pickled into every message.
+TaskMessage = collections.namedtuple('TaskMessage', [
+    'task_id',
+    'task_type',
+    'task_data',
+    'task_folder',
+    'task_outputs',
+    'task_tools_env',
+])
+
 class TaskWorker(process_manager.MessageReceiver):
     def __init__(self, channel, vars):
         super(TaskWorker, self).__init__(channel)
         self.buildPath = vars['buildPath']
+        self.buildPrefix = os.path.join(self.buildPath, '')
         self.pid = os.getpid()
         self.vars = vars
-        self.messageMap = {'task': lambda channel, message: self.receive_task(channel, message)}
+        self.messageMap = {
+            'task': lambda channel, message: self.receive_task(channel, TaskMessage._make(message))
+        }
         self.taskMap = {
             # When updating this, add to task_argv_debug().
             'cxx': lambda message: self.doCompile(message),
@@ -75,7 +101,7 @@ class TaskWorker(process_manager.MessageReceiver):
             'bin': lambda message: self.doBinaryWrite(message),
             # When updating this, add to task_argv_debug().
         }
-        self.try_send({'id': 'spawned'})
+        self.try_send('spawned')
 
     def onShutdown(self):
         pass
@@ -93,55 +119,105 @@ class TaskWorker(process_manager.MessageReceiver):
             return self.issueResponse(message, response)
 
     def process_task(self, channel, message):
-        task_id = message['task_id']
-        task_type = message['task_type']
-        task_folder = message['task_folder']
+        task_id = message.task_id
+        task_type = message.task_type
+        task_folder = message.task_folder
         if not task_folder:
             task_folder = '.'
 
         # Remove all outputs.
-        for output in message['task_outputs']:
-            try:
-                os.unlink(output)
-            except OSError as exn:
-                if exn.errno != errno.ENOENT:
-                    response = {
-                        'ok': False,
-                        'cmdline': 'rm {0}'.format(output),
-                        'stdout': '',
-                        'stderr': '{0}'.format(exn)
-                    }
-                    return self.issueResponse(message, response)
-
-        if not message['task_folder']:
-            message['task_folder'] = '.'
+        error = self.removeOutputs(message.task_outputs)
+        if error is not None:
+            output, exn = error
+            response = {
+                'ok': False,
+                'cmdline': 'rm {0}'.format(output),
+                'stdout': '',
+                'stderr': '{0}'.format(exn)
+            }
+            return self.issueResponse(message, response)
+
+        if not message.task_folder:
+            message = message._replace(task_folder = '.')
 
         # Do the task.
         response = self.taskMap[task_type](message)
         return self.issueResponse(message, response)
 
+    # Returns (output, exception) for the first output that could not be removed,
+    # or None. Outputs that are already gone are fine.
+    def removeOutputs(self, outputs):
+        unlink = os.unlink
+        if len(outputs) < UnlinkDirFdThreshold or not UnlinkDirFd:
+            for output in outputs:
+                try:
+                    unlink(output)
+                except OSError as exn:
+                    if exn.errno != ENOENT:
+                        return output, exn
+            return None
+
+        # When many outputs share a folder, open it once and remove them relative
+        # to it, so the kernel doesn't resolve the same path for every file.
+        folders = collections.OrderedDict()
+        for output in outputs:
+            folder, name = os.path.split(output)
+            folders.setdefault(folder, []).append((output, name))
+
+        for folder, entries in folders.items():
+            fd = None
+            if len(entries) >= UnlinkDirFdThreshold:
+                try:
+                    fd = os.open(folder or '.', os.O_RDONLY | os.O_DIRECTORY)
+                except OSError:
+                    pass
+            try:
+                for output, name in entries:
+                    try:
+                        if fd is None:
+                            unlink(output)
+                        else:
+                            unlink(name, dir_fd = fd)
+                    except OSError as exn:
+                        if exn.errno != ENOENT:
+                            return output, exn
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        return None
+
     def issueResponse(self, message, response):
-        # Compute new timestamps for all command outputs.
+        # Compute new timestamps for all command outputs. Stamps stay as float
+        # seconds, since that is what damage computation compares against.
+        outputs = message.task_outputs
         new_timestamps = []
         if response['ok']:
-            for output in message['task_outputs']:
+            new_timestamps = [None] * len(outputs)
+            stat = os.stat
+            for i, output in enumerate(outputs):
                 try:
-                    new_timestamps.append((output, os.path.getmtime(output)))
-                except:
+                    new_timestamps[i] = (output, stat(output).st_mtime)
+                except OSError:
                     response['ok'] = False
                     response['stderr'] += 'Expected output file, but not found: {0}'.format(output)
                     break
 
+        # Most tasks are silent, so leave out empty output streams rather than
+        # pickling them into every result.
+        if not response['stdout']:
+            del response['stdout']
+        if not response['stderr']:
+            del response['stderr']
+
         # Send a message back to the master process to update the DAG and spew
         # stdout/stderr if needed.
-        response['id'] = 'results'
-        response['task_id'] = message['task_id']
+        response['task_id'] = message.task_id
         response['updates'] = new_timestamps
-        self.try_send(response)
+        self.try_send('results', response)
 
-    def try_send(self, message):
+    def try_send(self, message_id, message = None):
         try:
-            self.channel.send(message)
+            self.channel.send(message_id, message)
         except OSError as e:
             if getattr(e, 'winerror', 0) == 232 or e.errno == errno.EPIPE:
                 # Parent is dead, so ignore the error.
@@ -149,9 +225,9 @@ class TaskWorker(process_manager.MessageReceiver):
             raise
 
     def doCommand(self, message):
-        task_folder = message['task_folder']
-        tools_env = message['task_tools_env']
-        argv = message['task_data']
+        task_folder = message.task_folder
+        tools_env = message.task_tools_env
+        argv = message.task_data
 
         env = None
         if tools_env is not None:
@@ -160,14 +236,13 @@ class TaskWorker(process_manager.MessageReceiver):
             if argv[0] in tools_env.tools:
                 argv[0] = tools_env.tools[argv[0]]
 
-        with util.FolderChanger(task_folder):
-            try:
-                p, stdout, stderr = util.Execute(argv, env = env)
-                status = p.returncode == 0
-            except Exception as exn:
-                status = False
-                stdout = ''
-                stderr = '{0}'.format(exn)
+        try:
+            p, stdout, stderr = util.Execute(argv, env = env, cwd = task_folder)
+            status = p.returncode == 0
+        except Exception as exn:
+            status = False
+            stdout = ''
+            stderr = '{0}'.format(exn)
 
         reply = {
             'ok': status,
@@ -178,8 +253,8 @@ class TaskWorker(process_manager.MessageReceiver):
         return reply
 
     def doSymlink(self, message):
-        task_folder = message['task_folder']
-        source_path, output_path = message['task_data']
+        task_folder = message.task_folder
+        source_path, output_path = message.task_data
 
         with util.FolderChanger(task_folder):
             rcode, stdout, stderr = util.symlink(source_path, output_path)
@@ -193,8 +268,8 @@ class TaskWorker(process_manager.MessageReceiver):
         return reply
 
     def doCopy(self, message):
-        task_folder = message['task_folder']
-        source_path, output_path = message['task_data']
+        task_folder = message.task_folder
+        source_path, output_path = message.task_data
 
         with util.FolderChanger(task_folder):
             if os.path.exists(source_path):
@@ -214,8 +289,8 @@ class TaskWorker(process_manager.MessageReceiver):
         return reply
 
     def doBinaryWrite(self, message):
-        task_folder = message['task_folder']
-        task_data = message['task_data']
+        task_folder = message.task_folder
+        task_data = message.task_data
         _, filename = os.path.split(task_data['path'])
 
         reply = {
@@ -233,31 +308,33 @@ class TaskWorker(process_manager.MessageReceiver):
                 reply['stderr'] = str(e)
         return reply
 
-    # Adjusts any dependencies relative to the current folder, to be relative to
+    # Adjusts any dependencies relative to the task folder, to be relative to
     # the output folder instead.
-    def rewriteDeps(self, deps):
+    def rewriteDeps(self, deps, task_folder):
+        build_prefix = self.buildPrefix
+        prefix_len = len(build_prefix)
+        isabs = os.path.isabs
+        abspath = os.path.abspath
+        join = os.path.join
+
         paths = []
         for inc_path in deps:
-            if not os.path.isabs(inc_path):
-                inc_path = os.path.abspath(inc_path)
+            if not isabs(inc_path):
+                inc_path = abspath(join(task_folder, inc_path))
 
             # Detect whether the include is within the build folder or not.
-            build_path = self.buildPath
-            if build_path[-1] != os.path.sep:
-                build_path += os.path.sep
-            prefix = os.path.commonprefix([build_path, inc_path])
-            if prefix == build_path:
+            if inc_path.startswith(build_prefix):
                 # The include is not a system include, i.e. it was generated, so
                 # rewrite the path to be relative to the build folder.
-                inc_path = os.path.relpath(inc_path, self.buildPath)
+                inc_path = os.path.normpath(inc_path[prefix_len:])
 
             paths.append(inc_path)
         return paths
 
     def doCompile(self, message):
-        task_folder = message['task_folder']
-        task_data = message['task_data']
-        tools_env = message['task_tools_env']
+        task_folder = message.task_folder
+        task_data = message.task_data
+        tools_env = message.task_tools_env
         cc_type = task_data['type']
         argv = task_data['argv']
 
@@ -274,9 +351,9 @@ class TaskWorker(process_manager.MessageReceiver):
             if 'cl' in tools_env.tools:
                 argv[0] = tools_env.tools['cl']
 
-        with util.FolderChanger(task_folder):
-            p, out, err = util.Execute(argv, env = env)
-            out, err, paths = self.parseDependencies(p, tools_env, out, err, dep_type, dep_info)
+        p, out, err = util.Execute(argv, env = env, cwd = task_folder)
+        out, err, paths = self.parseDependencies(p, task_folder, tools_env, out, err, dep_type,
+                                                 dep_info)
 
         reply = {
             'ok': p.returncode == 0,
@@ -287,17 +364,17 @@ class TaskWorker(process_manager.MessageReceiver):
         }
         return reply
 
-    def parseDependencies(self, p, tools_env, out, err, dep_type, dep_info):
+    def parseDependencies(self, p, task_folder, tools_env, out, err, dep_type, dep_info):
         if dep_type == 'md':
             try:
-                with open(dep_info) as fp:
+                with open(os.path.join(task_folder, dep_info)) as fp:
                     deps = make_parser.ParseDependencyFile(dep_info, fp)
             except:
                 if p.returncode == 0:
                     raise
                 deps = []
         elif dep_type == 'gcc':
-            err, deps = util.ParseGCCDeps(err)
+            err, deps = util.ParseGCCDeps(err, task_folder)
         elif dep_type == 'msvc':
             inclusion_pattern = GetMsvcInclusionPattern(self.vars, tools_env)
             out, deps = util.ParseMSVCDeps(out, inclusion_pattern)
@@ -306,13 +383,13 @@ class TaskWorker(process_manager.MessageReceiver):
         else:
             raise Exception('unknown dependency type')
 
-        paths = self.rewriteDeps(deps)
+        paths = self.rewriteDeps(deps, task_folder)
         return out, err, paths
 
     def doResource(self, message):
-        task_folder = message['task_folder']
-        task_data = message['task_data']
-        tools_env = message['task_tools_env']
+        task_folder = message.task_folder
+        task_data = message.task_data
+        tools_env = message.task_tools_env
         cl_argv = task_data['cl_argv']
         rc_argv = task_data['rc_argv']
 
@@ -327,14 +404,13 @@ class TaskWorker(process_manager.MessageReceiver):
             if 'rc' in tools_env.tools:
                 rc_argv[0] = tools_env.tools['rc']
 
-        with util.FolderChanger(task_folder):
-            # Includes go to stderr when we preprocess to stdout.
-            p, out, err = util.Execute(cl_argv, env = env)
-            out, deps = util.ParseMSVCDeps(err, inclusion_pattern)
-            paths = self.rewriteDeps(deps)
+        # Includes go to stderr when we preprocess to stdout.
+        p, out, err = util.Execute(cl_argv, env = env, cwd = task_folder)
+        out, deps = util.ParseMSVCDeps(err, inclusion_pattern)
+        paths = self.rewriteDeps(deps, task_folder)
 
-            if p.returncode == 0:
-                p, out, err = util.Execute(rc_argv, env = env)
+        if p.returncode == 0:
+            p, out, err = util.Execute(rc_argv, env = env, cwd = task_folder)
 
         reply = {
             'ok': p.returncode == 0,
@@ -346,24 +422,24 @@ class TaskWorker(process_manager.MessageReceiver):
         return reply
 
     def task_argv_debug(self, message):
-        task_data = message.get('task_data', None)
-        if message['task_type'] == 'rc':
+        task_data = message.task_data
+        if message.task_type == 'rc':
             cl_argv = task_data['cl_argv']
             rc_argv = task_data['rc_argv']
             return ' '.join([arg for arg in cl_argv]) + ' && ' + ' '.join([arg for arg in rc_argv])
-        elif message['task_type'] == 'cxx':
+        elif message.task_type == 'cxx':
             return ' '.join([arg for arg in task_data['argv']])
-        elif message['task_type'] == 'cmd':
+        elif message.task_type == 'cmd':
             return ' '.join([arg for arg in task_data])
-        elif message['task_type'] in ['cp', 'ln']:
-            task_folder = message['task_folder']
-            if message['task_type'] == 'cp':
+        elif message.task_type in ['cp', 'ln']:
+            task_folder = message.task_folder
+            if message.task_type == 'cp':
                 cmd = 'cp'
-            elif message['task_type'] == 'ln':
+            elif message.task_type == 'ln':
                 cmd = 'ln -s'
             return '{} "{}" "{}"'.format(cmd, task_data[0], os.path.join(task_folder, task_data[1]))
-        elif message['task_type'] == 'bin':
-            return 'write {}'.format(message['task_data']['path'])
+        elif message.task_type == 'bin':
+            return 'write {}'.format(message.task_data['path'])
 
 class TaskMaster(object):
     BUILD_IN_PROGRESS = 0
@@ -372,6 +448,11 @@ class TaskMaster(object):
     BUILD_FAILED = 3
     BUILD_INTERRUPTED = 4
 
+    # How many tasks a worker may have outstanding at once (at least 1). Workers
+    # handle messages in order, so a queued task starts as soon as the previous
+    # one finishes, without waiting for a round trip through this process.
+    PIPELINE_DEPTH = 2
+
     def __init__(self, cx, builder, task_graph, max_parallel):
         self.cx = cx
         self.builder = builder
@@ -383,10 +464,24 @@ class TaskMaster(object):
             'done': lambda child, message: self.receiveDone(child, message),
         }
         self.errors_ = []
-        self.task_graph = task_graph
+
+        # Ready tasks are kept in a heap, ordered by longest remaining path
+        # through the build, then by id.
+        self.task_graph = [(-task.bottom_level, task.id, task) for task in task_graph]
+        heapq.heapify(self.task_graph)
         self.workers_ = []
+
+        # Map of worker pid to a deque of the tasks it has been sent but has not
+        # finished yet, oldest first. Workers with nothing outstanding are not
+        # in the map.
         self.pending_ = {}
-        self.idle_ = set()
+
+        # Idle workers, longest-idle first, so that work rotates across all of
+        # them rather than landing on whichever one a set happens to yield.
+        self.idle_ = collections.deque()
+
+        # Busy workers that can still accept another task in their pipeline.
+        self.busy_ = collections.deque()
         self.build_completed_ = False
         self.failed_task_message = None
 
@@ -396,14 +491,15 @@ class TaskMaster(object):
             # since we incur the additional overhead of message passing. Instead,
             # we use two processes as the minimal number. If that turns out to be
             # bad we can create an in-process TaskMaster later.
-            if mp.cpu_count() == 1:
-                num_processes = 2
-            else:
-                num_processes = int(mp.cpu_count() * 1.25)
+            #
+            # Compiles are CPU-bound, and dispatch latency is already hidden by
+            # pipelining tasks to each worker, so don't oversubscribe beyond the
+            # CPUs available to us.
+            num_processes = max(util.CpuCount(), 2)
         else:
             num_processes = cx.options.jobs
 
-        # Don't create more processes than we'll need.
+        # Don't create more processes than the task graph can keep busy.
         if num_processes > max_parallel:
             num_processes = max_parallel
 
@@ -419,15 +515,17 @@ class TaskMaster(object):
                      color, message['cmdline'], util.ConsoleNormal)
         sys.stdout.flush()
 
-        if len(message['stdout']):
-            util.WriteEncodedText(sys.stdout, message['stdout'])
-            if message['stdout'][-1] != '\n':
+        stdout = message.get('stdout')
+        if stdout:
+            util.WriteEncodedText(sys.stdout, stdout)
+            if stdout[-1] != '\n':
                 sys.stdout.write('\n')
             sys.stdout.flush()
 
-        if len(message['stderr']):
-            util.WriteEncodedText(sys.stderr, message['stderr'])
-            if message['stderr'][-1] != '\n':
+        stderr = message.get('stderr')
+        if stderr:
+            util.WriteEncodedText(sys.stderr, stderr)
+            if stderr[-1] != '\n':
                 sys.stderr.write('\n')
             sys.stderr.flush()
 
@@ -435,7 +533,8 @@ class TaskMaster(object):
             self.failed_task_message = task.outputs[0]
 
     def recvTaskComplete(self, worker, message):
-        task = self.pending_[worker.pid]
+        pending = self.pending_[worker.pid]
+        task = pending[0]
 
         message['pid'] = worker.pid
         if not message['ok']:
@@ -445,10 +544,10 @@ class TaskMaster(object):
 
         self.spewResult(worker, task, message)
 
-        del self.pending_[worker.pid]
+        pending.popleft()
         if message['task_id'] != task.id:
             raise Exception('Worker {} returned wrong task id (got {}, expected {})'.format(
-                worker.pid, task_id, task.id))
+                worker.pid, message['task_id'], task.id))
 
         updates = message['updates']
         if not self.builder.updateGraph(task.id, updates, message):
@@ -456,23 +555,37 @@ class TaskMaster(object):
             self.terminateBuild(TaskMaster.BUILD_FAILED)
 
         # Enqueue any tasks that can be run if this was their last outstanding
-        # dependency.
+        # dependency. A large fan-out is cheaper to re-heapify in one pass than
+        # to push task by task.
+        ready = []
         for outgoing in task.outgoing:
-            outgoing.incoming.remove(task)
-            if len(outgoing.incoming) == 0:
-                self.task_graph.append(outgoing)
+            incoming = outgoing.incoming
+            incoming.remove(task)
+            if not incoming:
+                ready.append((-outgoing.bottom_level, outgoing.id, outgoing))
+        if len(ready) > len(self.task_graph):
+            self.task_graph.extend(ready)
+            heapq.heapify(self.task_graph)
+        else:
+            for item in ready:
+                heapq.heappush(self.task_graph, item)
+
+        # Return this process to the idle set, or make room for another task in
+        # its pipeline.
+        if not len(pending):
+            del self.pending_[worker.pid]
+            if TaskMaster.PIPELINE_DEPTH > 1:
+                self.busy_.remove(worker)
+            self.idle_.append(worker)
+        elif len(pending) == TaskMaster.PIPELINE_DEPTH - 1:
+            self.busy_.append(worker)
 
         if not len(self.task_graph) and not len(self.pending_):
             # There are no tasks remaining.
             self.status_ = TaskMaster.BUILD_SUCCEEDED
 
-        # Add this process to the idle set.
-        self.idle_.add(worker)
-
-        # If more stuff was queued, and we have idle processes, use them.
-        while len(self.task_graph) and len(self.idle_):
-            worker = self.idle_.pop()
-            self.issue_next_task(worker)
+        # If more stuff was queued, use any processes with room for it.
+        self.dispatch()
 
     def terminateBuild(self, status):
         self.status_ = status
@@ -501,37 +614,53 @@ class TaskMaster(object):
         if self.status_ != TaskMaster.BUILD_IN_PROGRESS:
             return
 
-        if not len(self.task_graph):
-            # If there are still tasks left to complete, they're waiting on others
-            # to finish. Mark this process as ready and just ignore the status
-            # change for now.
-            self.idle_.add(worker)
-            return
-
-        self.issue_next_task(worker)
+        # If there are no tasks ready yet, they're waiting on others to finish,
+        # and this process stays idle for now.
+        self.idle_.append(worker)
+        self.dispatch()
+
+    # Hand out ready tasks. Idle workers are used first.
+    #
+    # A task queued behind a running one cannot be taken back, so if the running
+    # task is slow, the queued one waits even when another worker frees up
+    # first. Tasks are therefore only queued while there are more of them ready
+    # than there are workers, where every worker will have work anyway and
+    # saving the round trip is worth it.
+    def dispatch(self):
+        task_graph = self.task_graph
+        idle = self.idle_
+        busy = self.busy_
+        num_workers = len(self.workers_)
+        issue_next_task = self.issue_next_task
+        while task_graph:
+            if idle:
+                worker = idle.popleft()
+            elif busy and len(task_graph) > num_workers:
+                worker = busy.popleft()
+            else:
+                break
+            issue_next_task(worker)
 
     def issue_next_task(self, worker):
-        task = self.task_graph.pop()
-        message = {
-            'id': 'task',
-            'task_id': task.id,
-            'task_type': task.type,
-            'task_data': task.data,
-            'task_folder': task.folder,
-            'task_outputs': task.outputs,
-            'task_tools_env': task.tools_env,
-        }
-        worker.channel.send(message)
-        self.pending_[worker.pid] = task
+        _, _, task = heapq.heappop(self.task_graph)
+        # Sent as a plain tuple in TaskMessage order.
+        message = (task.id, task.type, task.data, task.folder, task.outputs, task.tools_env)
+        worker.channel.send('task', message)
+
+        pending = self.pending_.setdefault(worker.pid, collections.deque())
+        pending.append(task)
+        if len(pending) < TaskMaster.PIPELINE_DEPTH:
+            self.busy_.append(worker)
 
     def pump(self):
         with process_manager.ChannelPoller(self.cx, self.workers_) as poller:
             while self.status_ == TaskMaster.BUILD_IN_PROGRESS:
                 try:
                     proc, obj = poller.poll()
-                    if obj['id'] not in self.messageMap:
-                        raise Exception('Unhandled message type: {}'.format(obj['id']))
-                    self.messageMap[obj['id']](proc, obj)
+                    message_id, message = obj
+                    if message_id not in self.messageMap:
+                        raise Exception('Unhandled message type: {}'.format(message_id))
+                    self.messageMap[message_id](proc, message)
                 except EOFError:
                     # The process died. Very sad. Clean up and fail the build.
                     util.con_err(util.ConsoleBlue, '[{0}]'.format(proc.pid), util.ConsoleNormal,
@@ -0,0 +1,35 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import os
+import shutil
+import tempfile
+import unittest
+from ambuild2 import task
+
+class RewriteDepsTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.path.realpath(tempfile.mkdtemp())
+        self.cwd = os.getcwd()
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def runTest(self):
+        # Workers run from the build folder.
+        worker = task.TaskWorker.__new__(task.TaskWorker)
+        worker.buildPath = self.folder
+        worker.buildPrefix = os.path.join(self.folder, '')
+
+        system_h = os.path.abspath(os.path.join(os.sep, 'usr', 'include', 'stdio.h'))
+        deps = [
+            os.path.join('gen', 'a.h'),
+            os.path.join('..', 'include', 'b.h'),
+            system_h,
+        ]
+        paths = worker.rewriteDeps(deps, os.path.join('obj', 'core'))
+        self.assertEqual(paths, [
+            os.path.join('obj', 'core', 'gen', 'a.h'),
+            os.path.join('obj', 'include', 'b.h'),
+            system_h,
+        ])
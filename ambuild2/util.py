@@ -3,6 +3,7 @@ import errno
 import subprocess
 import re, os, sys, locale
 import uuid
+import multiprocessing
 import platform
 from tempfile import NamedTemporaryFile
 
@@ -128,6 +129,13 @@ def IsMac():
 def IsSolaris():
     return sys.platform[0:5] == 'sunos'
 
+# The number of CPUs this process may run on. Unlike cpu_count(), this respects
+# affinity masks and cpusets where the platform can report them.
+def CpuCount():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
 def IsUnixy():
     return not IsWindows()
 
@@ -383,7 +391,13 @@ class Guard:
     def __exit__(self, type, value, traceback):
         self.obj.close()
 
-def Execute(argv, shell = False, env = None):
+def Execute(argv, shell = False, env = None, cwd = None):
+    # Windows resolves a relative program path against this process's current
+    # directory rather than cwd, so change into it instead.
+    if cwd is not None and IsWindows():
+        with FolderChanger(cwd):
+            return Execute(argv, shell = shell, env = env)
+
     if env is not None:
         env = SanitizeEnv(env)
     elif NeedsSanitizing(os.environ):
@@ -393,7 +407,8 @@ def Execute(argv, shell = False, env = None):
                          stdout = subprocess.PIPE,
                          stderr = subprocess.PIPE,
                          shell = shell,
-                         env = env)
+                         env = env,
+                         cwd = cwd)
     stdout, stderr = p.communicate()
     out = DecodeConsoleText(sys.stdout, stdout)
     err = DecodeConsoleText(sys.stderr, stderr)
@@ -409,7 +424,7 @@ else:
     BlobType = bytes
 
 def Unpickle(blob):
-    if type(blob) != bytes:
+    if type(blob) is not bytes:
         blob = bytes(blob)
     return pickle.loads(blob)
 
@@ -417,11 +432,16 @@ def Unpickle(blob):
 # run it if you using Python 2.
 PICKLE_PROTOCOL = min(2, pickle.HIGHEST_PROTOCOL)
 
+# Blobs in the graph database are only ever read back by Python 3, so they can
+# use a newer protocol. Protocol 4 (Python 3.4+) has compact opcodes for short
+# strings, which is most of what an argv is.
+BLOB_PICKLE_PROTOCOL = min(4, pickle.HIGHEST_PROTOCOL)
+
 def DiskPickle(obj, fp):
     return pickle.dump(obj, fp, PICKLE_PROTOCOL)
 
 def CompatPickle(obj):
-    return pickle.dumps(obj, PICKLE_PROTOCOL)
+    return pickle.dumps(obj, BLOB_PICKLE_PROTOCOL)
 
 def str2b(s):
     if bytes is str:
@@ -433,21 +453,30 @@ sLookForIncludeGuard = 1
 sFoundIncludeGuard = 2
 sIgnoring = 3
 
-def ParseGCCDeps(text):
+sGCCIncludeLine = re.compile(r'[\.!x]\.*\s+(.+)\s*$')
+sLineBreaks = re.compile('\n+')
+
+# Relative paths in the trace are relative to folder, the compiler's working
+# directory.
+def ParseGCCDeps(text, folder = '.'):
     deps = set()
     strip = False
-    new_text = ''
+    lines = []
+
+    match_include = sGCCIncludeLine.match
+    exists = os.path.exists
+    join = os.path.join
 
     state = sReadIncludes
-    for line in re.split('\n+', text):
+    for line in sLineBreaks.split(text):
         line = line.replace('\r', '')
         if state == sReadIncludes:
-            m = re.match('[\.!x]\.*\s+(.+)\s*$', line)
-            if m == None:
+            m = match_include(line)
+            if m is None:
                 state = sLookForIncludeGuard
             else:
-                name = m.groups()[0]
-                if os.path.exists(name):
+                name = m.group(1)
+                if name in deps or exists(join(folder, name)):
                     strip = True
                     deps.add(name)
                 else:
@@ -464,8 +493,11 @@ def ParseGCCDeps(text):
                 strip = False
                 state = sIgnoring
         if not strip and len(line):
-            new_text += line + '\n'
-    return new_text, deps
+            lines.append(line)
+
+    if not lines:
+        return '', deps
+    return '\n'.join(lines) + '\n', deps
 
 def ParseMSVCDeps(out, inclusion_pattern = None):
     if inclusion_pattern is not None:
@@ -639,8 +671,10 @@ def StringType():
     except NameError:
         return str
 
+StringTypes = StringType()
+
 def IsString(v):
-    return isinstance(v, StringType())
+    return isinstance(v, StringTypes)
 
 class Expando(object):
     pass
@@ -660,6 +694,16 @@ def rm_path(path):
                     ConsoleNormal, '\n', ConsoleRed, '{0}'.format(exn), ConsoleNormal)
             raise
 
+# Write a small file in one go, without going through a buffered file object.
+def WriteFileBytes(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        view = memoryview(data)
+        while len(view):
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
 def DecodeConsoleText(origin, text):
     try:
         if origin.encoding:
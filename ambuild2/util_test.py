@@ -0,0 +1,34 @@
+# vim: set sts=4 ts=8 sw=4 tw=99 et:
+import os
+import shutil
+import tempfile
+import unittest
+from ambuild2 import util
+
+class ParseGCCDepsTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def runTest(self):
+        os.makedirs(os.path.join('obj', 'gen'))
+        with open(os.path.join('obj', 'gen', 'a.h'), 'w') as fp:
+            fp.write('')
+        system_h = os.path.join(self.folder, 'b.h')
+        with open(system_h, 'w') as fp:
+            fp.write('')
+
+        # Relative includes only exist relative to the task folder, not to the
+        # current directory.
+        text = '. gen/a.h\n.. {0}\nwarning: unused variable\n'.format(system_h)
+        out, deps = util.ParseGCCDeps(text, 'obj')
+        self.assertEqual(deps, set(['gen/a.h', system_h]))
+        self.assertEqual(out, 'warning: unused variable\n')
+
+        out, deps = util.ParseGCCDeps(text)
+        self.assertNotIn('gen/a.h', deps)